@@ -1,10 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import logging
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response, status
 from sqlalchemy.orm import Session
-from typing import List, Union, Optional
+from typing import Callable, List, Union, Optional
 
 from . import crud, schemas, security, rag_system
 from .database import get_db
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(
     prefix="/api/v1",
     tags=["Medical Records"],
@@ -59,6 +62,195 @@ def create_new_medical_record(
             detail=f"An internal error occurred: {str(e)}"
         )
 
+def compact_vector_index():
+    """
+    Background job that rebuilds the vector index to reclaim the space held by deleted records.
+    """
+    try:
+        rag_system.rag_system.compact()
+    except Exception:
+        logger.exception("Vector index compaction failed")
+
+def compensate(action: Callable[[], None], description: str):
+    """
+    Runs a compensating vector store write after a failed request. A failure here is
+    logged rather than raised so the caller still reports the original error.
+    """
+    try:
+        action()
+    except Exception:
+        logger.exception(f"Failed to {description}; SQL and vector store may be out of sync")
+
+@router.put("/records/{record_id}", response_model=schemas.MedicalRecordInDB)
+def update_medical_record(
+    record_id: int,
+    record: schemas.MedicalRecordUpdate,
+    db: Session = Depends(get_db),
+    api_key: str = Depends(security.get_api_key)
+):
+    """
+    Update the content of an existing medical record.
+    - Updates the record in the SQL database.
+    - Re-embeds the record and upserts it in place in the Vector DB.
+    """
+    db_record = crud.get_medical_record(db, record_id=record_id)
+    if not db_record:
+        raise HTTPException(status_code=404, detail="Record not found")
+
+    if not security.check_permissions(api_key, db_record.patient_id):
+        raise HTTPException(status_code=403, detail="Not authorized to access this patient's records")
+
+    previous_vector = None
+    try:
+        db_record = crud.update_medical_record(db=db, db_record=db_record, record_content=record.record_content)
+        db.flush()
+
+        previous_vector = rag_system.rag_system.upsert_record(
+            record_content=db_record.record_content,
+            record_id=db_record.id,
+            patient_id=db_record.patient_id
+        )
+
+        db.commit()
+        db.refresh(db_record)
+        return db_record
+
+    except Exception as e:
+        db.rollback()
+        # Keep the vector in line with the rolled back SQL content
+        if previous_vector is not None:
+            compensate(
+                lambda: rag_system.rag_system.revert_upsert(record_id, previous_vector),
+                f"revert vector of record {record_id}"
+            )
+        raise HTTPException(
+            status_code=500,
+            detail=f"An internal error occurred: {str(e)}"
+        )
+
+@router.delete("/records/{record_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_medical_record(
+    record_id: int,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    api_key: str = Depends(security.get_api_key)
+):
+    """
+    Delete a medical record from both the SQL database and the Vector DB.
+    Schedules a background compaction once enough deletions have accumulated.
+    """
+    db_record = crud.get_medical_record(db, record_id=record_id)
+    if not db_record:
+        raise HTTPException(status_code=404, detail="Record not found")
+
+    if not security.check_permissions(api_key, db_record.patient_id):
+        raise HTTPException(status_code=403, detail="Not authorized to access this patient's records")
+
+    deleted_vectors = None
+    try:
+        crud.delete_medical_record(db=db, db_record=db_record)
+        db.flush()
+
+        deleted_vectors = rag_system.rag_system.delete_records([record_id])
+
+        db.commit()
+
+    except Exception as e:
+        db.rollback()
+        if deleted_vectors is not None:
+            compensate(
+                lambda: rag_system.rag_system.restore_records(deleted_vectors),
+                f"restore {len(deleted_vectors['ids'])} deleted vectors"
+            )
+        raise HTTPException(
+            status_code=500,
+            detail=f"An internal error occurred: {str(e)}"
+        )
+
+    if rag_system.rag_system.needs_compaction():
+        background_tasks.add_task(compact_vector_index)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+@router.delete("/patients/{patient_id}/records", response_model=schemas.RecordDeletionResult)
+def delete_patient_records(
+    patient_id: int,
+    background_tasks: BackgroundTasks,
+    purge: bool = False,
+    db: Session = Depends(get_db),
+    api_key: str = Depends(security.get_api_key)
+):
+    """
+    Delete all medical records of a patient (e.g. for retention-policy purges).
+    - Deletes the records from the SQL database.
+    - Deletes the matching vectors from the Vector DB in batches.
+    - Schedules a background compaction once enough deletions have accumulated, or
+      always with `purge=true` (retention deletions), so the deleted data is removed from disk.
+    """
+    db_patient = crud.get_patient(db, patient_id=patient_id)
+    if not db_patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    if not security.check_permissions(api_key, patient_id):
+        raise HTTPException(status_code=403, detail="Not authorized to access this patient's records")
+
+    deleted_vectors = None
+    try:
+        record_ids = crud.get_record_ids_by_patient(db, patient_id=patient_id)
+        deleted_count = crud.delete_records_by_patient(db, patient_id=patient_id)
+        db.flush()
+
+        # A failed batch puts back the batches already deleted before raising
+        deleted_vectors = rag_system.rag_system.delete_records(record_ids)
+
+        db.commit()
+
+    except Exception as e:
+        db.rollback()
+        if deleted_vectors is not None:
+            compensate(
+                lambda: rag_system.rag_system.restore_records(deleted_vectors),
+                f"restore {len(deleted_vectors['ids'])} deleted vectors"
+            )
+        raise HTTPException(
+            status_code=500,
+            detail=f"An internal error occurred: {str(e)}"
+        )
+
+    compaction_scheduled = rag_system.rag_system.needs_compaction() or (purge and bool(deleted_vectors["ids"]))
+    if compaction_scheduled:
+        background_tasks.add_task(compact_vector_index)
+
+    return schemas.RecordDeletionResult(
+        patient_id=patient_id,
+        deleted_count=deleted_count,
+        compaction_scheduled=compaction_scheduled
+    )
+
+@router.post("/maintenance/compact", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.CompactionStatus)
+def schedule_compaction(background_tasks: BackgroundTasks):
+    """
+    Schedule a background compaction of the vector index.
+    The index size before and after the run is available from `GET /maintenance/compact`.
+    """
+    background_tasks.add_task(compact_vector_index)
+    return schemas.CompactionStatus(
+        tombstone_count=rag_system.rag_system.tombstone_count,
+        last_compaction=rag_system.rag_system.last_compaction,
+        last_failure=rag_system.rag_system.last_compaction_failure
+    )
+
+@router.get("/maintenance/compact", response_model=schemas.CompactionStatus)
+def get_compaction_status():
+    """
+    Number of deletions since the last compaction, the report of the last compaction run
+    and the last failed run, if any.
+    """
+    return schemas.CompactionStatus(
+        tombstone_count=rag_system.rag_system.tombstone_count,
+        last_compaction=rag_system.rag_system.last_compaction,
+        last_failure=rag_system.rag_system.last_compaction_failure
+    )
+
 @router.get(
     "/search/",
     response_model=Union[List[schemas.PatientMedicalRecordSearchResult], List[schemas.AnonymizedMedicalRecordSearchResult]],
@@ -4,6 +4,12 @@ class Settings(BaseSettings):
     ultrasafe_api_key: str
     ultrasafe_api_base: str
     valid_api_key: str
+    # Vector store maintenance
+    vector_delete_batch_size: int = 500
+    compaction_tombstone_threshold: int = 1000
+    compaction_batch_size: int = 500
+    # Wait before a failed compaction is scheduled again by the deletion threshold
+    compaction_retry_backoff_seconds: int = 3600
 
     model_config = SettingsConfigDict(env_file=".env")
 
@@ -22,4 +22,22 @@ def get_records_by_ids(db: Session, record_ids: list[int]):
 def create_medical_record(db: Session, record_content: str, patient_id: int):
     db_record = models.MedicalRecord(record_content=record_content, patient_id=patient_id)
     db.add(db_record)
-    return db_record
\ No newline at end of file
+    return db_record
+
+def get_record_ids_by_patient(db: Session, patient_id: int) -> list[int]:
+    rows = db.query(models.MedicalRecord.id).filter(models.MedicalRecord.patient_id == patient_id).all()
+    return [row.id for row in rows]
+
+def update_medical_record(db: Session, db_record: models.MedicalRecord, record_content: str):
+    db_record.record_content = record_content
+    return db_record
+
+def delete_medical_record(db: Session, db_record: models.MedicalRecord):
+    db.delete(db_record)
+
+def delete_records_by_patient(db: Session, patient_id: int) -> int:
+    return (
+        db.query(models.MedicalRecord)
+        .filter(models.MedicalRecord.patient_id == patient_id)
+        .delete(synchronize_session=False)
+    )
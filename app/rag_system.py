@@ -1,19 +1,33 @@
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
 import httpx
 import chromadb
 from chromadb.config import Settings
 from .config import settings
 from . import models
 from typing import List, Dict, Any
+
+# Fields of a collection.get() result needed to put vectors back exactly as they were
+SNAPSHOT_INCLUDE = ["embeddings", "documents", "metadatas"]
+# Chroma keeps each HNSW segment in a directory named after the segment id
+SEGMENT_DIR_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
 class RAGSystem:
     _instance = None
 
-    def __new__(cls):
+    def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super(RAGSystem, cls).__new__(cls)
             cls._instance.initialized = False
         return cls._instance
 
-    def __init__(self, recreate_collection: bool = False):
+    def __init__(self, recreate_collection: bool = False, persist_path: str = "./chroma_db"):
         if self.initialized and not recreate_collection:
             return
             
@@ -31,26 +45,73 @@ class RAGSystem:
         self.http_client = httpx.Client(headers=self.headers, timeout=30.0)
         
         # --- ChromaDB Setup (with telemetry disabled) ---
+        self.persist_path = persist_path
         self.chroma_client = chromadb.PersistentClient(
-            path="./chroma_db",
+            path=self.persist_path,
             settings=Settings(anonymized_telemetry=False)
         )
         self.collection_name = "medical_records"
+
+        # The state file points at the active collection (compaction swaps it for a
+        # freshly built one) and persists the maintenance counters across restarts.
+        self.state_path = os.path.join(self.persist_path, "index_state.json")
+        state = self._load_state()
+        active_name = state.get("collection", self.collection_name)
         
         if recreate_collection:
             try:
-                self.chroma_client.delete_collection(name=self.collection_name)
-                print(f"Collection '{self.collection_name}' deleted successfully.")
+                self.chroma_client.delete_collection(name=active_name)
+                print(f"Collection '{active_name}' deleted successfully.")
             except Exception as e:
                 print(f"An unexpected error occurred while deleting collection: {e}")
+            active_name = self.collection_name
+            state = {}
 
         self.collection = self.chroma_client.get_or_create_collection(
-            name=self.collection_name,
+            name=active_name,
             metadata={"hnsw:space": "cosine"}
         )
+        # Guards collection writes and the collection swap done by compact()
+        self.lock = threading.RLock()
+        # Only one compaction may run at a time
+        self.compaction_lock = threading.Lock()
+        # Ids written while a compaction copies the collection, replayed before the swap
+        self._dirty_ids: set[str] | None = None
+        # Number of vectors deleted since the last compaction. Chroma only marks
+        # deleted HNSW entries as tombstones, so the index keeps their space.
+        self.tombstone_count = state.get("tombstone_count", 0)
+        self.last_compaction = state.get("last_compaction")
+        self.last_compaction_failure = state.get("last_compaction_failure")
+        self._save_state()
         self.initialized = True
         print("RAG System Initialized.")
 
+    def _load_state(self) -> Dict[str, Any]:
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _current_state(self) -> Dict[str, Any]:
+        return {
+            "collection": self.collection.name,
+            "tombstone_count": self.tombstone_count,
+            "last_compaction": self.last_compaction,
+            "last_compaction_failure": self.last_compaction_failure
+        }
+
+    def _save_state(self, state: Dict[str, Any] | None = None):
+        # Write to a temporary file and rename it so the pointer is never half-written
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state or self._current_state(), f)
+        os.replace(tmp_path, self.state_path)
+
+    def _mark_dirty(self, ids: List[str]):
+        if self._dirty_ids is not None:
+            self._dirty_ids.update(ids)
+
     def get_embedding(self, text: str) -> list[float]:
         """
         Gets an embedding for a given text using the specified embeddings API.
@@ -75,12 +136,237 @@ class RAGSystem:
 
     def add_record(self, record_content: str, record_id: int, patient_id: int):
         embedding = self.get_embedding(record_content)
-        self.collection.add(
-            embeddings=[embedding],
-            documents=[record_content],
-            metadatas=[{"sql_record_id": record_id, "patient_id": patient_id}],
-            ids=[str(record_id)]
-        )
+        with self.lock:
+            self.collection.add(
+                embeddings=[embedding],
+                documents=[record_content],
+                metadatas=[{"sql_record_id": record_id, "patient_id": patient_id}],
+                ids=[str(record_id)]
+            )
+            self._mark_dirty([str(record_id)])
+
+    def upsert_record(self, record_content: str, record_id: int, patient_id: int) -> Dict[str, Any]:
+        """
+        Replaces the embedding, document and metadata of an existing record in place
+        (or adds it if it is missing), keeping the same vector id.
+
+        Returns a snapshot of the previous vector for `revert_upsert`.
+        """
+        embedding = self.get_embedding(record_content)
+        with self.lock:
+            previous = self.collection.get(ids=[str(record_id)], include=SNAPSHOT_INCLUDE)
+            self.collection.upsert(
+                embeddings=[embedding],
+                documents=[record_content],
+                metadatas=[{"sql_record_id": record_id, "patient_id": patient_id}],
+                ids=[str(record_id)]
+            )
+            self._mark_dirty([str(record_id)])
+        return previous
+
+    def revert_upsert(self, record_id: int, previous: Dict[str, Any]):
+        """
+        Undoes `upsert_record` using the snapshot it returned.
+        """
+        with self.lock:
+            if previous["ids"]:
+                self.collection.upsert(**{key: previous[key] for key in ["ids", *SNAPSHOT_INCLUDE]})
+            else:
+                self.collection.delete(ids=[str(record_id)])
+            self._mark_dirty([str(record_id)])
+
+    def delete_records(self, record_ids: List[int]) -> Dict[str, Any]:
+        """
+        Deletes records from the vector store in batches of
+        `settings.vector_delete_batch_size` ids per call.
+
+        If a batch fails, the batches already deleted are put back before the error
+        is raised. Returns a snapshot of the deleted vectors for `restore_records`.
+        """
+        ids = [str(record_id) for record_id in record_ids]
+        batch_size = settings.vector_delete_batch_size
+        deleted = {key: [] for key in ["ids", *SNAPSHOT_INCLUDE]}
+        with self.lock:
+            self._mark_dirty(ids)
+            try:
+                for start in range(0, len(ids), batch_size):
+                    existing = self.collection.get(ids=ids[start:start + batch_size], include=SNAPSHOT_INCLUDE)
+                    if not existing["ids"]:
+                        continue
+                    self.collection.delete(ids=existing["ids"])
+                    for key in deleted:
+                        deleted[key].extend(existing[key])
+            except Exception:
+                if deleted["ids"]:
+                    self.collection.upsert(**deleted)
+                raise
+            # Only ids that were actually in the index leave a tombstone behind
+            self.tombstone_count += len(deleted["ids"])
+            self._save_state()
+        return deleted
+
+    def restore_records(self, snapshot: Dict[str, Any]):
+        """
+        Puts back vectors removed by `delete_records`, e.g. when the SQL delete is rolled back.
+        """
+        if not snapshot["ids"]:
+            return
+        with self.lock:
+            self.collection.upsert(**snapshot)
+            self._mark_dirty(snapshot["ids"])
+            self.tombstone_count = max(0, self.tombstone_count - len(snapshot["ids"]))
+            self._save_state()
+
+    def needs_compaction(self) -> bool:
+        if self.tombstone_count < settings.compaction_tombstone_threshold:
+            return False
+        # Back off after a failure instead of retrying a full copy on every delete
+        if self.last_compaction_failure is None:
+            return True
+        elapsed = time.time() - self.last_compaction_failure["failed_at"]
+        return elapsed >= settings.compaction_retry_backoff_seconds
+
+    def index_size(self) -> Dict[str, int]:
+        """
+        Returns the number of live vectors and the on-disk size of the vector store.
+        """
+        disk_bytes = 0
+        for root, _, files in os.walk(self.persist_path):
+            for name in files:
+                try:
+                    disk_bytes += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return {"vector_count": self.collection.count(), "disk_bytes": disk_bytes}
+
+    def _drop_orphaned_collections(self):
+        """
+        Deletes collections left behind by an interrupted compaction: either a
+        partially built copy or an old collection the state file no longer points at.
+        Only names this class generates are considered, never the active collection.
+        """
+        pattern = re.compile(rf"^{re.escape(self.collection_name)}(_[0-9a-f]{{32}})?$")
+        dropped_ids = []
+        for collection in self.chroma_client.list_collections():
+            name = collection if isinstance(collection, str) else collection.name
+            if name != self.collection.name and pattern.match(name):
+                print(f"Dropping orphaned collection '{name}'.")
+                dropped_ids.append(str(self.chroma_client.get_collection(name=name).id))
+                self.chroma_client.delete_collection(name=name)
+        if dropped_ids:
+            with self.lock:
+                self._purge_dropped_collections(dropped_ids)
+
+    def _purge_dropped_collections(self, collection_ids: List[str]):
+        """
+        Removes what Chroma leaves on disk after `delete_collection`, so that no
+        deleted record stays readable: the collections' log entries, the full-text
+        index entries and freed SQLite pages (optimize + VACUUM), and the HNSW
+        segment directories no remaining segment references.
+        """
+        connection = sqlite3.connect(os.path.join(self.persist_path, "chroma.sqlite3"), timeout=30)
+        try:
+            tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            with connection:
+                if "embeddings_queue" in tables:
+                    for collection_id in collection_ids:
+                        connection.execute("DELETE FROM embeddings_queue WHERE topic LIKE ?", (f"%{collection_id}",))
+                if "embedding_fulltext_search" in tables:
+                    connection.execute(
+                        "INSERT INTO embedding_fulltext_search(embedding_fulltext_search) VALUES ('optimize')"
+                    )
+            connection.execute("VACUUM")
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            segment_ids = {row[0] for row in connection.execute("SELECT id FROM segments")}
+        finally:
+            connection.close()
+
+        for name in os.listdir(self.persist_path):
+            path = os.path.join(self.persist_path, name)
+            if os.path.isdir(path) and SEGMENT_DIR_PATTERN.match(name) and name not in segment_ids:
+                print(f"Removing unreferenced segment directory '{name}'.")
+                shutil.rmtree(path)
+
+    def _copy_vectors(self, source, target, ids: List[str], upsert: bool = False):
+        batch_size = settings.compaction_batch_size
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            page = source.get(ids=batch, include=SNAPSHOT_INCLUDE)
+            if page["ids"]:
+                write = target.upsert if upsert else target.add
+                write(**{key: page[key] for key in ["ids", *SNAPSHOT_INCLUDE]})
+            if upsert:
+                # Ids missing from the source were deleted during the copy
+                removed = list(set(batch) - set(page["ids"]))
+                if removed:
+                    stale = target.get(ids=removed, include=[])["ids"]
+                    if stale:
+                        target.delete(ids=stale)
+
+    def compact(self) -> Dict[str, Any] | None:
+        """
+        Rebuilds the collection from its live vectors so that the space held by
+        deleted (tombstoned) entries is reclaimed and no deleted record is left on disk.
+
+        The live vectors are copied into a fresh collection without holding the
+        write lock; writes made meanwhile are replayed before the swap. The state
+        file is pointed at the new collection before the old one is dropped and
+        purged from disk. Embeddings are reused, so no embedding API calls are made.
+
+        Returns a report with the index size before and after compaction, or None
+        if a compaction is already running. A failure is recorded in the state so
+        that `needs_compaction` backs off before scheduling another run.
+        """
+        if not self.compaction_lock.acquire(blocking=False):
+            print("A compaction is already running.")
+            return None
+        try:
+            return self._compact()
+        except Exception as e:
+            with self.lock:
+                self.last_compaction_failure = {"failed_at": time.time(), "error": str(e)}
+                try:
+                    self._save_state()
+                except OSError as save_error:
+                    print(f"Could not record the compaction failure: {save_error}")
+            raise
+        finally:
+            self.compaction_lock.release()
+
+    def _compact(self) -> Dict[str, Any]:
+        self._drop_orphaned_collections()
+
+        with self.lock:
+            before = self.index_size()
+            old_collection = self.collection
+            live_ids = old_collection.get(include=[])["ids"]
+            self._dirty_ids = set()
+        print(f"Compacting collection '{old_collection.name}' ({self.tombstone_count} tombstones)...")
+
+        try:
+            new_collection = self.chroma_client.create_collection(
+                name=f"{self.collection_name}_{uuid.uuid4().hex}",
+                metadata={"hnsw:space": "cosine"}
+            )
+            self._copy_vectors(old_collection, new_collection, live_ids)
+
+            with self.lock:
+                self._copy_vectors(old_collection, new_collection, list(self._dirty_ids), upsert=True)
+                self._save_state({**self._current_state(), "collection": new_collection.name, "tombstone_count": 0})
+                self.collection = new_collection
+                self.tombstone_count = 0
+        finally:
+            with self.lock:
+                self._dirty_ids = None
+
+        self.chroma_client.delete_collection(name=old_collection.name)
+        with self.lock:
+            self._purge_dropped_collections([str(old_collection.id)])
+            self.last_compaction = {"before": before, "after": self.index_size()}
+            self.last_compaction_failure = None
+            self._save_state()
+        print(f"Compaction complete. Before: {before}, after: {self.last_compaction['after']}")
+        return self.last_compaction
 
     def search(self, query: str, top_k: int = 5, patient_id: int | None = None) -> list[dict]:
         query_embedding = self.get_embedding(query)
@@ -93,7 +379,14 @@ class RAGSystem:
         if patient_id is not None:
             query_args["where"] = {"patient_id": patient_id}
 
-        results = self.collection.query(**query_args)
+        collection = self.collection
+        try:
+            results = collection.query(**query_args)
+        except Exception:
+            # A compaction may have swapped and dropped the collection mid-query
+            if self.collection is collection:
+                raise
+            results = self.collection.query(**query_args)
         
         if not results['ids'] or not results['ids'][0]:
             return []
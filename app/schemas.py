@@ -12,6 +12,12 @@ class MedicalRecordCreate(MedicalRecordBase):
     """
     patient_id: int
 
+class MedicalRecordUpdate(MedicalRecordBase):
+    """
+    Used to validate the body of a `PUT /records/{record_id}` request
+    """
+    pass
+
 class MedicalRecordInDB(MedicalRecordBase):
     """
     Used validate the response fields in API
@@ -23,6 +29,14 @@ class MedicalRecordInDB(MedicalRecordBase):
     class Config:
         from_attributes = True
 
+class RecordDeletionResult(BaseModel):
+    """
+    Response of a bulk `DELETE /patients/{patient_id}/records` request
+    """
+    patient_id: int
+    deleted_count: int
+    compaction_scheduled: bool
+
 # --- Patient Schemas ---
 class PatientBase(BaseModel):
     full_name: str
@@ -55,4 +69,25 @@ class AnonymizedMedicalRecordSearchResult(BaseModel):
     patient_identifier: str = "[REDACTED]"
     record_content: str
     created_at: datetime
-    relevance_score: float
\ No newline at end of file
+    relevance_score: float
+
+# --- Maintenance Schemas ---
+class IndexSize(BaseModel):
+    vector_count: int
+    disk_bytes: int
+
+class CompactionReport(BaseModel):
+    """
+    Vector index size before and after the last compaction run.
+    """
+    before: IndexSize
+    after: IndexSize
+
+class CompactionFailure(BaseModel):
+    failed_at: datetime
+    error: str
+
+class CompactionStatus(BaseModel):
+    tombstone_count: int
+    last_compaction: Optional[CompactionReport] = None
+    last_failure: Optional[CompactionFailure] = None
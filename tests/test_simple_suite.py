@@ -1,10 +1,12 @@
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 import os
+import sqlite3
 import sys
 from datetime import date
+from unittest import mock
 
 # Add the parent directory to the path to allow importing from 'app'
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -13,6 +15,9 @@ from app.main import app
 from app.database import Base, get_db
 from app.config import settings
 from app.models import Patient, MedicalRecord
+from app import rag_system as rag_module
+from app.rag_system import RAGSystem
+from chromadb.api.models.Collection import Collection
 
 # --- Test Database Setup ---
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test_temp.db"
@@ -86,4 +91,255 @@ def test_create_record_patient_not_found():
     payload = {"patient_id": 999, "record_content": "Unknown patient."}
     response = client.post("/api/v1/records/", json=payload, headers=VALID_API_KEY_HEADER)
     assert response.status_code == 404
-    assert "Patient not found" in response.json()["detail"] 
\ No newline at end of file
+    assert "Patient not found" in response.json()["detail"]
+
+# --- Vector store maintenance (mocked embeddings, temporary Chroma path) ---
+def fake_embedding(text: str) -> list[float]:
+    return [1.0, float(len(text)), float(sum(map(ord, text)) % 97)]
+
+def make_vector_store(path: str) -> RAGSystem:
+    # Bypass the singleton so each test gets its own store
+    store = object.__new__(RAGSystem)
+    store.initialized = False
+    store.__init__(persist_path=path)
+    store.get_embedding = fake_embedding
+    return store
+
+@pytest.fixture
+def vector_store(tmp_path, monkeypatch):
+    store = make_vector_store(str(tmp_path / "chroma_db"))
+    store.add_record("Patient has mild fever and cough.", record_id=202, patient_id=2)
+    monkeypatch.setattr(rag_module, "rag_system", store)
+    return store
+
+def add_records(store: RAGSystem, record_ids: list[int]):
+    for record_id in record_ids:
+        store.add_record(f"Record {record_id}", record_id=record_id, patient_id=3)
+
+# 6. Update a medical record
+def test_update_medical_record(vector_store):
+    payload = {"record_content": "Patient has mild fever, cough resolved."}
+    response = client.put("/api/v1/records/202", json=payload, headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["id"] == 202
+    assert data["patient_id"] == 2
+    assert "cough resolved" in data["record_content"]
+    vector = vector_store.collection.get(ids=["202"])
+    assert vector["documents"] == ["Patient has mild fever, cough resolved."]
+    assert vector_store.collection.count() == 1
+
+# 7. Update a missing record
+def test_update_record_not_found(vector_store):
+    response = client.put("/api/v1/records/999", json={"record_content": "x"}, headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 404
+    assert "Record not found" in response.json()["detail"]
+
+# 8. Delete a medical record
+def test_delete_medical_record(vector_store):
+    assert vector_store.collection.count() == 1
+    response = client.delete("/api/v1/records/202", headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 204
+    assert vector_store.collection.count() == 0
+    assert vector_store.tombstone_count == 1
+    response = client.delete("/api/v1/records/202", headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 404
+    assert "Record not found" in response.json()["detail"]
+
+# 9. Bulk delete all records of a patient
+def test_delete_patient_records(vector_store):
+    response = client.delete("/api/v1/patients/2/records", headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["patient_id"] == 2
+    assert data["deleted_count"] == 1
+    assert data["compaction_scheduled"] is False
+    assert vector_store.collection.count() == 0
+
+# 10. Bulk delete for an unknown patient
+def test_delete_patient_records_not_found(vector_store):
+    response = client.delete("/api/v1/patients/999/records", headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 404
+    assert "Patient not found" in response.json()["detail"]
+
+# 11. Update/delete without permission on the patient
+def test_update_and_delete_forbidden(vector_store, monkeypatch):
+    monkeypatch.setattr("app.security.check_permissions", lambda api_key, patient_id: False)
+    responses = [
+        client.put("/api/v1/records/202", json={"record_content": "x"}, headers=VALID_API_KEY_HEADER),
+        client.delete("/api/v1/records/202", headers=VALID_API_KEY_HEADER),
+        client.delete("/api/v1/patients/2/records", headers=VALID_API_KEY_HEADER),
+    ]
+    assert all(response.status_code == 403 for response in responses)
+    assert vector_store.collection.count() == 1
+
+# 12. Single deletes trigger compaction once the threshold is reached
+def test_single_delete_schedules_compaction(vector_store, monkeypatch):
+    monkeypatch.setattr(settings, "compaction_tombstone_threshold", 1)
+    response = client.delete("/api/v1/records/202", headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 204
+    response = client.get("/api/v1/maintenance/compact", headers=VALID_API_KEY_HEADER)
+    data = response.json()
+    assert data["tombstone_count"] == 0
+    assert data["last_compaction"]["before"]["vector_count"] == 0
+
+# 13. Manual compaction endpoints
+def test_compaction_endpoints(vector_store):
+    response = client.post("/api/v1/maintenance/compact", headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 202
+    response = client.get("/api/v1/maintenance/compact", headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 200
+    report = response.json()["last_compaction"]
+    assert report["before"]["vector_count"] == 1
+    assert report["after"]["vector_count"] == 1
+    assert report["after"]["disk_bytes"] > 0
+
+# 14. Deletes are sent in batches and only existing ids count as tombstones
+def test_delete_records_batching(vector_store, monkeypatch):
+    monkeypatch.setattr(settings, "vector_delete_batch_size", 2)
+    add_records(vector_store, [1, 2, 3, 4, 5])
+    original_delete = Collection.delete
+    with mock.patch.object(Collection, "delete", autospec=True, side_effect=original_delete) as delete:
+        deleted = vector_store.delete_records([1, 2, 3, 4, 5, 404])
+    assert delete.call_count == 3  # ceil(6 / 2)
+    assert sorted(deleted["ids"]) == ["1", "2", "3", "4", "5"]
+    assert vector_store.tombstone_count == 5
+    assert vector_store.collection.count() == 1
+
+# 15. A failed batch puts back the batches already deleted
+def test_delete_records_failed_batch_is_restored(vector_store, monkeypatch):
+    monkeypatch.setattr(settings, "vector_delete_batch_size", 2)
+    add_records(vector_store, [1, 2, 3, 4])
+    original_delete = Collection.delete
+    calls = []
+
+    def failing_delete(collection, *args, **kwargs):
+        calls.append(kwargs)
+        if len(calls) == 2:
+            raise RuntimeError("vector store unavailable")
+        return original_delete(collection, *args, **kwargs)
+
+    with mock.patch.object(Collection, "delete", autospec=True, side_effect=failing_delete):
+        with pytest.raises(RuntimeError):
+            vector_store.delete_records([1, 2, 3, 4])
+    assert vector_store.collection.count() == 5
+    assert vector_store.tombstone_count == 0
+
+# 16. Compaction keeps the live ids and survives a restart
+def test_compact_keeps_live_ids(vector_store):
+    add_records(vector_store, [1, 2, 3, 4])
+    vector_store.delete_records([1, 2])
+    old_name = vector_store.collection.name
+
+    report = vector_store.compact()
+    assert report["before"]["vector_count"] == 3
+    assert report["after"]["vector_count"] == 3
+    assert report["after"]["disk_bytes"] > 0
+    assert vector_store.tombstone_count == 0
+    assert vector_store.collection.name != old_name
+    assert sorted(vector_store.collection.get(include=[])["ids"]) == ["202", "3", "4"]
+
+    restarted = make_vector_store(vector_store.persist_path)
+    assert restarted.collection.name == vector_store.collection.name
+    assert restarted.last_compaction == report
+    assert sorted(restarted.collection.get(include=[])["ids"]) == ["202", "3", "4"]
+
+# 17. Tombstone count is persisted across restarts
+def test_tombstone_count_persisted(vector_store):
+    add_records(vector_store, [1, 2])
+    vector_store.delete_records([1, 2])
+    restarted = make_vector_store(vector_store.persist_path)
+    assert restarted.tombstone_count == 2
+
+# 18. An interrupted swap keeps the live collection; only generated orphans are dropped
+def test_interrupted_compaction_keeps_live_data(vector_store):
+    add_records(vector_store, [1, 2])
+    unrelated = vector_store.chroma_client.create_collection(name="medical_records_stale")
+    with mock.patch.object(RAGSystem, "_save_state", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            vector_store.compact()
+    assert vector_store.collection.name == "medical_records"
+    assert vector_store.collection.count() == 3
+
+    restarted = make_vector_store(vector_store.persist_path)
+    assert restarted.collection.count() == 3
+    restarted.compact()
+    names = {c if isinstance(c, str) else c.name for c in restarted.chroma_client.list_collections()}
+    assert names == {restarted.collection.name, unrelated.name}
+
+# 19. Compaction frees disk space and leaves no deleted record on disk
+def test_compact_reclaims_disk_and_purges_deleted_records(tmp_path):
+    store = make_vector_store(str(tmp_path / "chroma_db"))
+    record_ids = list(range(3000))
+    for start in range(0, len(record_ids), 500):
+        batch = record_ids[start:start + 500]
+        store.collection.add(
+            ids=[str(record_id) for record_id in batch],
+            embeddings=[[float((record_id * k) % 17 + 1) for k in range(64)] for record_id in batch],
+            documents=[f"Deleted note {record_id}" if record_id < 2700 else f"Live note {record_id}" for record_id in batch],
+            metadatas=[{"sql_record_id": record_id, "patient_id": 3} for record_id in batch]
+        )
+    store.delete_records(record_ids[:2700])
+
+    report = store.compact()
+    assert report["before"]["vector_count"] == 300
+    assert report["after"]["vector_count"] == 300
+    assert report["after"]["disk_bytes"] < report["before"]["disk_bytes"]
+
+    connection = sqlite3.connect(os.path.join(store.persist_path, "chroma.sqlite3"))
+    segment_ids = {row[0] for row in connection.execute("SELECT id FROM segments")}
+    connection.close()
+    segment_dirs = {
+        name for name in os.listdir(store.persist_path)
+        if os.path.isdir(os.path.join(store.persist_path, name))
+    }
+    assert segment_dirs <= segment_ids
+
+    contents = b""
+    for root, _, files in os.walk(store.persist_path):
+        for name in files:
+            with open(os.path.join(root, name), "rb") as f:
+                contents += f.read()
+    assert b"Deleted note" not in contents
+    assert b"Live note 2999" in contents
+
+# 20. A failed compaction backs off instead of being rescheduled on every delete
+def test_failed_compaction_backs_off(vector_store, monkeypatch):
+    monkeypatch.setattr(settings, "compaction_tombstone_threshold", 1)
+    vector_store.delete_records([202])
+    assert vector_store.needs_compaction()
+
+    with mock.patch.object(RAGSystem, "_copy_vectors", side_effect=RuntimeError("copy failed")):
+        with pytest.raises(RuntimeError):
+            vector_store.compact()
+    assert vector_store.last_compaction_failure["error"] == "copy failed"
+    assert not vector_store.needs_compaction()
+
+    restarted = make_vector_store(vector_store.persist_path)
+    assert restarted.last_compaction_failure["error"] == "copy failed"
+    monkeypatch.setattr(settings, "compaction_retry_backoff_seconds", 0)
+    assert restarted.needs_compaction()
+
+    response = client.get("/api/v1/maintenance/compact", headers=VALID_API_KEY_HEADER)
+    assert response.json()["last_failure"]["error"] == "copy failed"
+
+# 21. A failing compensating write does not hide the original error
+def test_failed_restore_keeps_original_error(vector_store, monkeypatch):
+    def failing_commit(session):
+        raise RuntimeError("commit failed")
+
+    def failing_restore(snapshot):
+        raise RuntimeError("vector store down")
+
+    monkeypatch.setattr(Session, "commit", failing_commit)
+    monkeypatch.setattr(vector_store, "restore_records", failing_restore)
+    response = client.delete("/api/v1/records/202", headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 500
+    assert "commit failed" in response.json()["detail"]
+
+# 22. Retention purges always schedule a compaction
+def test_purge_patient_records_schedules_compaction(vector_store):
+    response = client.delete("/api/v1/patients/2/records?purge=true", headers=VALID_API_KEY_HEADER)
+    assert response.status_code == 200
+    assert response.json()["compaction_scheduled"] is True
+    assert vector_store.last_compaction["after"]["vector_count"] == 0